@@ -7,53 +7,108 @@ Search for satellite images in specified geographical area.
 3. Export a list of products which we will download.
 """
 import os
-import sys
-import json
 import pathlib
+import threading
 import datetime
+import functools
 import collections
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 
+import orjson
 import requests
-import requests_cache
-
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from diskcache import Cache
+from tqdm import tqdm
+from lxml import etree as ET
+
+import numpy as np
+import pandas as pd
 import shapefile
 from shapely.geometry import MultiPolygon
-import shapely.wkt as swkt
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+import shapely
 
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
+from geometry import exterior_rings
 
 
-requests_cache.install_cache("sentinel_cache")
+# Directories of the disk caches, opened on first use
+ODATA_CACHE_DIR = "odata_cache"
+ODATA_CACHE_EXPIRE = 7 * 24 * 60 * 60
+SEARCH_CACHE_DIR = "search_cache"
+SEARCH_METAS_EXPIRE = 6 * 60 * 60
 
 # Bounding box is defined by lon lat lon lat, imagine 4 lines
-BOUNDS_GERMANY = ["5.86442", "47.26543", "15.05078", "55.14777"]
+BOUNDS_GERMANY = ("5.86442", "47.26543", "15.05078", "55.14777")
 COPERNICUS_USER = os.environ["COPERNICUS_USER"]
 COPERNICUS_PASS = os.environ["COPERNICUS_PASS"]
-
-
-def bounds_to_points(bound_box):
-    lon1, lat1, lon2, lat2 = bound_box
-    return [
-        (lon1, lat1), (lon2, lat1), (lon2, lat2), (lon1, lat2), (lon1, lat1)
-    ]
+# Compressed response encodings urllib3 can decode without extra packages
+HTTP_ENCODINGS = "gzip, deflate"
+# Number of products resolved concurrently against the OData API
+ODATA_WORKERS = 16
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Number of byte ranges of a product downloaded concurrently
+DOWNLOAD_PARTS = 8
+# Searches are split into a grid of SEARCH_TILES x SEARCH_TILES areas.
+# Cells are kept a few times larger than a product footprint, since
+# products overlapping several cells are returned by each of them.
+SEARCH_TILES = 3
+SEARCH_WORKERS = 8
+SEARCH_PAGE_WORKERS = 8
+SEARCH_MAX_REQUESTS = 16
+# Relative footprint area which may remain uncovered to count as covered
+COVER_TOLERANCE = 1e-9
+
+# XML parsers must not be shared between threads
+_XML_PARSERS = threading.local()
 
 
 def create_query(terms):
-    query = " AND ".join(f"{k}:{v}" for k, v in terms.items())
+    query = " AND ".join([f"{k}:{v}" for k, v in terms.items()])
     return f"({query})"
 
 
-def polygon_from_points(points):
-    points = ",".join(" ".join(b) for b in points)
-    return f"POLYGON(({points}))"
+@functools.lru_cache(maxsize=1024)
+def polygon_from_bound_box(box):
+    lon1, lat1, lon2, lat2 = box
+    return (f"POLYGON(({lon1} {lat1},{lon2} {lat1},{lon2} {lat2},"
+            f"{lon1} {lat2},{lon1} {lat1}))")
+
 
+def z_order(x, y):
+    """Return Z-order curve index of integer grid coordinates."""
+    index = 0
+    for bit in range(max(x.bit_length(), y.bit_length())):
+        index |= ((x >> bit) & 1) << (2 * bit)
+        index |= ((y >> bit) & 1) << (2 * bit + 1)
+    return index
 
-def polygon_from_bound_box(box):
-    return polygon_from_points(bounds_to_points(box))
+
+@functools.lru_cache(maxsize=64)
+def tile_bounds(box, nx=SEARCH_TILES, ny=SEARCH_TILES):
+    """Split bounding box into a grid of nx times ny bounding boxes.
+
+    Boxes are returned in Z-order, so that consecutive boxes are spatial
+    neighbours. Both the box and the result are tuples, so that the grid
+    can be memoized.
+    """
+    lon1, lat1, lon2, lat2 = (float(b) for b in box)
+    lons = [f"{lon1 + (lon2 - lon1) * i / nx:.5f}" for i in range(nx + 1)]
+    lats = [f"{lat1 + (lat2 - lat1) * i / ny:.5f}" for i in range(ny + 1)]
+    cells = sorted(
+        ((x, y) for x in range(nx) for y in range(ny)),
+        key=lambda c: z_order(*c))
+    return tuple(
+        (lons[x], lats[y], lons[x + 1], lats[y + 1]) for x, y in cells)
+
+
+@functools.lru_cache(maxsize=None)
+def disk_cache(directory):
+    """Return the disk cache in directory, opening it on first use."""
+    return Cache(directory)
 
 
 def selectsingle(items):
@@ -68,12 +123,62 @@ def select_prod_builder(key):
     return filterfun
 
 
-def parse_size(size):
-    if size.endswith("GB"):
-        size = float(size[:-3]) * 1000
-    else:
-        size = float(size[:-3])
-    return size
+def parse_xml(text):
+    """Parse XML response text into an lxml tree."""
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    parser = getattr(_XML_PARSERS, "parser", None)
+    if parser is None:
+        # ids are never looked up in the results
+        parser = ET.XMLParser(huge_tree=True, collect_ids=False)
+        _XML_PARSERS.parser = parser
+    return ET.fromstring(text, parser=parser)
+
+
+def parse_sizes(sizes):
+    """Return array of sizes in MB from size strings like "24.05 MB"."""
+    sizes = np.asarray(sizes, dtype=str)
+    values = np.char.rstrip(sizes, " KMGB").astype(float)
+    return np.where(np.char.endswith(sizes, "GB"), values * 1000, values)
+
+
+@functools.lru_cache(maxsize=65536)
+def filename_to_tci_name(filename):
+    fileparts = filename.split("_")
+    tci_name = f"{fileparts[5]}_{fileparts[2]}_TCI_10m.jp2"
+    return tci_name
+
+
+def parse_date(value):
+    """Parse OpenSearch date, which ends in milliseconds and timezone.
+
+    The layout is fixed (2019-05-01T10:20:31.024Z), so the fields are sliced
+    directly instead of going through strptime.
+    """
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+
+# Converters for OpenSearch entry field types
+FIELD_CONVERTERS = {
+    # Keep missing text as None
+    "str": lambda value: value,
+    "int": int,
+    "double": float,
+    "date": parse_date,
+}
+
+
+def _compile_fields(entry_fields, ns):
+    """Return (field, XPath, converter) for every entry field. XPaths are
+    compiled once instead of per entry and field."""
+    return tuple(
+        (field,
+         ET.XPath(f"./a:{field_type}[@name=$n]", namespaces=ns),
+         FIELD_CONVERTERS[field_type])
+        for field, field_type in entry_fields.items()
+    )
 
 
 class OData:
@@ -83,17 +188,44 @@ class OData:
     _ns = {
         "a": "http://www.w3.org/2005/Atom",
     }
+    _title_xpath = ET.XPath(".//a:entry/a:title", namespaces=_ns)
 
     def __init__(self, user, password):
         self._user = user
         self._password = password
 
         self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(
+            pool_connections=ODATA_WORKERS * 2,
+            pool_maxsize=ODATA_WORKERS * 2,
+            max_retries=Retry(
+                total=3, backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504])))
+        self._session.headers["Accept-Encoding"] = HTTP_ENCODINGS
 
     def request(self, path, params=None):
+        """Return response text for the given path. Node listings of products
+        do not change, so they are cached in memory and on disk across
+        runs."""
+        params = tuple(sorted((params or {}).items()))
+        if path.endswith("$value"):
+            return self._get(path, params)
+        return self._cached_get(path, params)
+
+    @functools.lru_cache(maxsize=4096)
+    def _cached_get(self, path, params):
+        key = (path, params)
+        cache = disk_cache(ODATA_CACHE_DIR)
+        text = cache.get(key)
+        if text is None:
+            text = self._get(path, params)
+            cache.set(key, text, expire=ODATA_CACHE_EXPIRE)
+        return text
+
+    def _get(self, path, params):
         url = f"{self.base_url}/{path}"
         req = self._session.get(
-            url, params=params, auth=(self._user, self._password))
+            url, params=dict(params), auth=(self._user, self._password))
         req.raise_for_status()
         return req.text
 
@@ -103,10 +235,8 @@ class OData:
         OData returns nodes in XML format, which we parse and return a list of
         filenames.
         """
-        text = self.request(path)
-        tree = ET.fromstring(text)
-        filename_nodes = tree.findall(
-            ".//a:entry/a:title", namespaces=self._ns)
+        tree = parse_xml(self.request(path))
+        filename_nodes = self._title_xpath(tree)
         filenames = [n.text for n in filename_nodes]
         return filenames
 
@@ -121,62 +251,106 @@ class OData:
         result = self.request("$metadata")
         print(result)
 
+    def granule_name(self, uuid, filename):
+        """Return name of the single GRANULE node of the given product."""
+        path = f"/Products('{uuid}')/Nodes('{filename}')/Nodes('GRANULE')/Nodes"
+        return selectsingle(self.request_nodes(path))
+
     def get_tci_image_path(self, uuid, filename):
-        """Return complete TCI Image path by iteratively filling missing info
-        from node tree traversal."""
-        fileparts = filename.split("_")
-        tci_name = f"{fileparts[5]}_{fileparts[2]}_TCI_10m.jp2"
-        # path elems as List of Tuples
-        # Strings are used as is, otherwise the value has to be callable
-        # The function filters returned filenames to return a single string
+        """Return complete TCI Image path. The only unknown node in the path
+        is the product granule, which is requested from the node tree."""
+        tci_name = filename_to_tci_name(filename)
         path_elems = [
             ("Products", uuid),
             ("Nodes", filename),
             ("Nodes", "GRANULE"),
-            ("Nodes", selectsingle),
+            ("Nodes", self.granule_name(uuid, filename)),
             ("Nodes", "IMG_DATA"),
             ("Nodes", "R10m"),
-            # ("Nodes", select_prod_builder("TCI")),
             ("Nodes", tci_name),
         ]
-
-        # Get node for current step by either appending literal string or
-        # Requesting filenames and using filterfunction in value
-        parsed_path_elems = []
-        querypath = ""
-        for name, value in path_elems:
-            if not isinstance(value, str):
-                filterfun = value
-                filenames = self.request_nodes(querypath + "/Nodes")
-                value = filterfun(filenames)
-
-            parsed_path_elems.append((name, value))
-            querypath += f"/{name}('{value}')"
-
+        querypath = "".join(f"/{name}('{value}')" for name, value in path_elems)
         querypath += "/$value"
         return querypath
 
     def download(self, path, outpath):
-        """Download data at path to given outpath."""
+        """Download data at path to given outpath.
+
+        The hub limits bandwidth per connection, so the file is fetched as
+        DOWNLOAD_PARTS byte ranges in parallel, each written at its own
+        offset. Servers not answering range requests are read as one stream.
+        """
         url = f"{self.base_url}/{path}"
         pathlib.Path(outpath).parent.mkdir(parents=True, exist_ok=True)
         filename = pathlib.Path(outpath).name
-        with requests_cache.disabled():
-            with requests.get(url, stream=True, auth=(self._user, self._password)) as r:
-                r.raise_for_status()
-                total_length = int(r.headers.get('content-length'))
-                downloaded = 0
-                with open(outpath, "wb") as outfile:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            outfile.write(chunk)
-                            downloaded += len(chunk)
-                            done = int(50 * downloaded / total_length)
-                            sys.stdout.write(
-                                f"\r{filename}: [{'='*done}{' '*(50-done)}]")
-                            sys.stdout.flush()
+        auth = (self._user, self._password)
+        # Same encoding as the range requests, so that content-length is the
+        # size of the unencoded file
+        with self._session.head(
+                url, auth=auth, allow_redirects=True,
+                headers={"Accept-Encoding": "identity"}) as r:
+            r.raise_for_status()
+            total_length = int(r.headers.get("content-length", 0))
+        bounds = [total_length * i // DOWNLOAD_PARTS
+                  for i in range(DOWNLOAD_PARTS + 1)]
+        ranges = [(lo, hi - 1) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+        # tqdm updates the progress bar at most every 0.1 seconds
+        with open(outpath, "wb") as outfile, tqdm(
+                total=total_length, desc=filename, unit="B", unit_scale=True,
+                mininterval=0.1) as progress:
+            fd = outfile.fileno()
+            lock = threading.Lock()
+            if len(ranges) < 2:
+                first = self._session.get(url, stream=True, auth=auth)
+            else:
+                first = self._get_range(url, *ranges[0])
+            with first:
+                first.raise_for_status()
+                if first.status_code != 206:
+                    first.raw.decode_content = True
+                    self._write_stream(first, fd, 0, progress, lock)
+                    return path
+                os.truncate(fd, total_length)
+                with ThreadPoolExecutor(len(ranges) - 1) as pool:
+                    parts = [
+                        pool.submit(
+                            self._download_range, url, lo, hi, fd,
+                            progress, lock)
+                        for lo, hi in ranges[1:]
+                    ]
+                    self._write_stream(first, fd, 0, progress, lock)
+                    for part in parts:
+                        part.result()
         return path
 
+    def _get_range(self, url, lo, hi):
+        # Ranges refer to the unencoded file, so ask for it as is
+        return self._session.get(
+            url, stream=True, auth=(self._user, self._password),
+            headers={"Range": f"bytes={lo}-{hi}",
+                     "Accept-Encoding": "identity"})
+
+    def _download_range(self, url, lo, hi, fd, progress, lock):
+        with self._get_range(url, lo, hi) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RuntimeError(
+                    f"Range {lo}-{hi} of {url} not served: {r.status_code}")
+            self._write_stream(r, fd, lo, progress, lock)
+
+    @staticmethod
+    def _write_stream(response, fd, offset, progress, lock):
+        """Write response body to file descriptor starting at offset."""
+        while True:
+            chunk = response.raw.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            with lock:
+                progress.update(len(chunk))
+
 
 ODATA = OData(COPERNICUS_USER, COPERNICUS_PASS)
 
@@ -212,91 +386,185 @@ class OpenSearch:
         "unclassifiedpercentage": "double",
     }
 
+    _fields = _compile_fields(entry_fields, _ns)
+    _entry_tag = f"{{{_ns['a']}}}entry"
+    _total_tag = f"{{{_ns['os']}}}totalResults"
+    _start_tag = f"{{{_ns['os']}}}startIndex"
+
     def __init__(self, user, password):
+        # Not cached on HTTP level, so that responses are parsed while they
+        # are received. Parsed results are cached by search_metas.
         self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=5, backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504])))
+        self._session.headers["Accept-Encoding"] = HTTP_ENCODINGS
+        # Limit concurrent requests against the hub across all searches
+        self._request_slots = threading.BoundedSemaphore(SEARCH_MAX_REQUESTS)
         self._user = user
         self._password = password
 
     @classmethod
     def parse_entry(cls, entry):
         """Convert entry in XML into a python dict."""
-        meta = {}
-        for field, field_type in cls.entry_fields.items():
-            value = entry.find(
-                f".//a:{field_type}[@name='{field}']", cls._ns).text
-            if field_type == "double":
-                value = float(value)
-            elif field_type == "int":
-                value = int(value)
-            elif field_type == "date":
-                value = datetime.datetime.strptime(
-                    value[:-5], "%Y-%m-%dT%H:%M:%S")
-            meta[field] = value
-        return meta
-
-    def _parse_xml(self, tree):
-        """Return list of elements and some parsed results from XML"""
-        if isinstance(tree, str):
-            tree = ET.fromstring(tree)
-
-        total_results = tree.find(".//os:totalResults", self._ns).text
-        start_index = tree.find(".//os:startIndex", self._ns).text
-        # title = tree.findall(".//", self._ns)
-        entries = tree.findall(".//a:entry", self._ns)
         return {
-            "start_index": start_index,
-            "total_results": total_results,
-            "entries": entries,
+            field: convert(xpath(entry, n=field)[0].text)
+            for field, xpath, convert in cls._fields
         }
 
+    def _parse_xml(self, source):
+        """Return result counts and a generator of parsed entries from a XML
+        response stream.
+
+        The feed header precedes all entries, so counts are read eagerly while
+        entries are only parsed when the generator is consumed.
+        """
+        events = ET.iterparse(
+            source, events=("end",),
+            tag=(self._total_tag, self._start_tag, self._entry_tag),
+            huge_tree=True, collect_ids=False)
+        header = {}
+        first_entry = None
+        for _, elem in events:
+            if elem.tag == self._entry_tag:
+                first_entry = elem
+                break
+            header[elem.tag] = elem.text
+        return {
+            "start_index": header.get(self._start_tag),
+            "total_results": header.get(self._total_tag),
+            "entries": self._iter_entries(first_entry, events),
+        }
+
+    @classmethod
+    def _iter_entries(cls, entry, events):
+        """Yield entries as dicts, dropping each XML node after conversion."""
+        while entry is not None:
+            yield cls.parse_entry(entry)
+            entry.clear()
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+            entry = next(events, (None, None))[1]
+
     def search_raw(self, query, start=0, rows=100):
-        url = f"{self.base_url}/search?start={start}&rows={rows}&q=" + query
-        resp = self._session.get(url, auth=(self._user, self._password))
+        """Return streamed response of the XML search. The caller has to
+        close it, to hand the connection back to the pool."""
+        url = f"{self.base_url}/search"
+        params = {"start": start, "rows": rows, "q": query}
+        resp = self._session.get(
+            url, params=params, auth=(self._user, self._password), stream=True)
         if resp.status_code != 200:
+            resp.close()
             raise RuntimeError(resp)
-        return resp.text
+        resp.raw.decode_content = True
+        return resp
+
+    def _search_page(self, query, start, rows):
+        """Return total number of results and parsed entries of one page."""
+        with self._request_slots:
+            with self.search_raw(query, start=start, rows=rows) as resp:
+                result = self._parse_xml(resp.raw)
+                return int(result["total_results"]), list(result["entries"])
 
-    def search(self, *args, **kwargs):
-        """Wrapper around query and XML parser."""
-        return self._parse_xml(self.search_raw(*args, **kwargs))
+    def search_terms(self, terms, rows=100):
+        """Search using given query string, yielding entries as dicts.
 
-    def search_terms(self, terms):
-        """Search using given query string."""
+        Once the first page returned the number of results, all remaining
+        pages are requested concurrently. Entries are yielded in page order.
+        """
         query = create_query(terms)
-        max_index = 0
-        entries = []
-        result = self.search(query)
-        entries += result["entries"]
-        max_index = int(result["total_results"])
-        while len(entries) < max_index:
-            print(f"Getting {len(entries)}")
-            result = self.search(query, start=len(entries))
-            entries += result["entries"]
-        return entries
+        max_index, entries = self._search_page(query, 0, rows)
+        yield from entries
+        with ThreadPoolExecutor(max_workers=SEARCH_PAGE_WORKERS) as executor:
+            pages = [
+                executor.submit(self._search_page, query, start, rows)
+                for start in range(rows, max_index, rows)
+            ]
+            for page in pages:
+                _, entries = page.result()
+                yield from entries
 
 
 SEARCH = OpenSearch(COPERNICUS_USER, COPERNICUS_PASS)
 
 
+@functools.lru_cache(maxsize=64)
+def _search_metas(term_items):
+    cache = disk_cache(SEARCH_CACHE_DIR)
+    metas = cache.get(term_items)
+    if metas is None:
+        metas = list(SEARCH.search_terms(dict(term_items)))
+        cache.set(term_items, metas, expire=SEARCH_METAS_EXPIRE)
+    return metas
+
+
+def search_metas(terms):
+    """Return list of parsed metas for the search terms.
+
+    Results are memoized in memory and on disk, so analyses running the same
+    query share a single search. The returned list must not be modified.
+    """
+    return _search_metas(tuple(sorted(terms.items())))
+
+
+def metas_to_frame(metas):
+    """Return metas as a DataFrame with one column per entry field. Rows keep
+    the list positions as index, to select the original meta dicts."""
+    return pd.DataFrame(metas, columns=list(OpenSearch.entry_fields))
+
+
+def load_footprints(metas):
+    """Return footprint geometries of metas.
+
+    Many products share a footprint, so every distinct WKT is only parsed
+    once. All distinct footprints are parsed together in a single call.
+    """
+    wkts = [m["footprint"] for m in metas]
+    unique = list(dict.fromkeys(wkts))
+    footprints = dict(zip(unique, shapely.from_wkt(unique)))
+    return [footprints[w] for w in wkts]
+
+
+def search_bound_box(terms, box):
+    """Search products intersecting the bounding box. The box is queried as a
+    grid of smaller areas concurrently, results are merged on uuid."""
+    queries = [
+        dict(terms, footprint=f"\"Intersects({polygon_from_bound_box(b)})\"")
+        for b in tile_bounds(box)
+    ]
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+        results = executor.map(search_metas, queries)
+        metas = merge_metas([], [m for result in results for m in result])
+    return metas
+
+
 def export_meta_shapes_to_shapefile(metas, outpath):
     """Export generated meta shapes to shapefile for visual inspection in QGIS."""
     with shapefile.Writer(outpath) as shp:
         shp.field("name", "C")
         shp.field("cloudcover", "C")
-        for i, meta in enumerate(metas):
-            footprint = meta["footprint"]
-            polys = swkt.loads(meta["footprint"])
-            if isinstance(polys, MultiPolygon):
-                coords = [list(poly.exterior.coords) for poly in polys.geoms]
-            else:
-                coords = [list(polys.exterior.coords)]
+        footprints = load_footprints(metas)
+        for i, (meta, coords) in enumerate(
+                zip(metas, exterior_rings(footprints))):
             shp.poly(coords)
             shp.record(f"polygon{i}", meta["cloudcoverpercentage"])
 
 
+def import_pyplot():
+    """Import pyplot only when plotting, plots are only saved to files."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def plot_footprint_coverage(poly, satellite="S2A"):
     """Show footprint of single tiles and plot some statistics.
     Geographical plots are created in qgis"""
+    plt = import_pyplot()
 
     terms = {
         "platformname": "Sentinel-2",
@@ -305,8 +573,7 @@ def plot_footprint_coverage(poly, satellite="S2A"):
         "footprint": f"\"Intersects({poly})\"",
         # "cloudcoverpercentage": "0",
     }
-    entries = SEARCH.search_terms(terms)
-    metas = [SEARCH.parse_entry(e) for e in entries]
+    metas = search_metas(terms)
 
     # create shapefiles
     export_meta_shapes_to_shapefile(metas, "shapefiles/{satellite.lower()}")
@@ -327,6 +594,7 @@ def plot_footprint_coverage(poly, satellite="S2A"):
 
 def plot_cloud_coverage(poly, plot_cloudbins=False, order_footprint=False):
     """Plot distribution of cloud cover"""
+    plt = import_pyplot()
     terms = {
         "platformname": "Sentinel-2",
         "producttype": "S2MSI2A",
@@ -334,17 +602,14 @@ def plot_cloud_coverage(poly, plot_cloudbins=False, order_footprint=False):
         # "cloudcoverpercentage": "0",
     }
 
-    entries = SEARCH.search_terms(terms)
-    metas = [SEARCH.parse_entry(e) for e in entries]
+    metas = search_metas(terms)
+    frame = metas_to_frame(metas)
 
     if plot_cloudbins:
         # binning metas on cloudcover
-        binned_cloud = [
-            round(m["cloudcoverpercentage"] / 10) * 10 for m in metas]
-        cloud_counts = collections.Counter(binned_cloud)
-
-        bins = list(sorted(cloud_counts.keys()))
-        values = [cloud_counts[b] for b in bins]
+        binned_cloud = np.round(
+            frame["cloudcoverpercentage"].to_numpy() / 10).astype(int) * 10
+        bins, values = np.unique(binned_cloud, return_counts=True)
         ypos = list(range(len(bins)))
         plt.bar(ypos, values)
         plt.xticks(ypos, labels=bins)
@@ -356,17 +621,19 @@ def plot_cloud_coverage(poly, plot_cloudbins=False, order_footprint=False):
 
     # groupby entries with same footprint
     if order_footprint:
-        same_footprint = collections.defaultdict(list)
+        min_cloud = {}
         for meta in metas:
-            same_footprint[meta["footprint"]].append(meta)
+            best = min_cloud.get(meta["footprint"])
+            if (best is None or meta["cloudcoverpercentage"]
+                    < best["cloudcoverpercentage"]):
+                min_cloud[meta["footprint"]] = meta
 
-        for foot, group in same_footprint.items():
-            min_cloud = min(group, key=lambda m: m["cloudcoverpercentage"])
-            print(foot, min_cloud["cloudcoverpercentage"])
+        for foot, meta in min_cloud.items():
+            print(foot, meta["cloudcoverpercentage"])
 
     for perc in [10, 20, 30, 40, 50, 60, 70, 80, 90]:
-        low_cloud_meta = [
-            m for m in metas if m["cloudcoverpercentage"] <= perc]
+        low_cloud = frame.index[frame["cloudcoverpercentage"] <= perc]
+        low_cloud_meta = [metas[i] for i in low_cloud]
         export_meta_shapes_to_shapefile(
             low_cloud_meta, f"shapefiles/low_cloud_{perc}")
 
@@ -377,63 +644,61 @@ def reduce_footprint_unique(metas):
     """
     metas = sorted(metas, key=lambda m: m["cloudcoverpercentage"])
     shapes = []
-    for meta in metas:
-        poly = swkt.loads(meta["footprint"])
+    for poly in load_footprints(metas):
         if isinstance(poly, MultiPolygon):
             assert len(poly.geoms) == 1
             shapes.extend(poly.geoms)
         else:
             shapes.append(poly)
 
+    # A footprint only adds coverage if it is not covered by the union of
+    # already selected footprints overlapping it
+    tree = STRtree(shapes)
     selected = []
-    union_area = None
+    prepared = {}
     for i, shape in enumerate(shapes):
-        if union_area is None:
-            union_area = shape
-            selected.append(i)
-        else:
-            prev_size = union_area.area
-            union_area = union_area.union(shape)
-            if prev_size < union_area.area:
-                selected.append(i)
+        neighbours = [j for j in tree.query(shape) if j in prepared]
+        if any(prepared[j].covers(shape) for j in neighbours):
+            continue
+        if neighbours:
+            # Shared edges rarely cover exactly, so compare the uncovered area
+            local_union = unary_union([shapes[j] for j in neighbours])
+            uncovered = shape.difference(local_union).area
+            if uncovered <= COVER_TOLERANCE * shape.area:
+                continue
+        selected.append(i)
+        prepared[i] = prep(shape)
 
     filtered = [metas[i] for i in selected]
     return filtered
 
 
-def filter_cover_set(poly):
+def filter_cover_set(box):
     """Test filtering entries down to smallest cover set for germany."""
     terms = {
         "platformname": "Sentinel-2",
         "producttype": "S2MSI2A",
-        "footprint": f"\"Intersects({poly})\"",
         # "cloudcoverpercentage": "0",
     }
-    entries = SEARCH.search_terms(terms)
-    metas = [SEARCH.parse_entry(e) for e in entries]
-    print("All:", len(metas))
+    metas = search_bound_box(terms, box)
+    frame = metas_to_frame(metas)
+    print("All:", len(frame))
 
-    filtered = [m for m in metas if m["cloudcoverpercentage"] < 10]
-    print("Only <10% clouds:", len(filtered))
+    frame = frame[frame["cloudcoverpercentage"] < 10]
+    print("Only <10% clouds:", len(frame))
 
-    same_footprint = collections.defaultdict(list)
-    for meta in filtered:
-        same_footprint[meta["footprint"]].append(meta)
+    # keep entry with least cloud cover for each footprint
+    frame = frame.loc[frame.groupby("footprint", sort=False)[
+        "cloudcoverpercentage"].idxmin()]
+    print("Only same footprint:", len(frame))
 
-    filtered = [
-        min(v, key=lambda m: m["cloudcoverpercentage"])
-        for v in same_footprint.values()
-    ]
-    print("Only same footprint:", len(filtered))
-
-    filtered = reduce_footprint_unique(filtered)
+    filtered = reduce_footprint_unique([metas[i] for i in frame.index])
     print("Reduce based on uniques:", len(filtered))
 
-    sum_size = sum(parse_size(m["size"]) for m in filtered)
+    sum_size = parse_sizes([m["size"] for m in filtered]).sum()
     print("Summed data size", sum_size / 1000, "GB")
-    avgcover = sum(m["cloudcoverpercentage"] for m in filtered)/len(filtered)
-    maxcover = max(m["cloudcoverpercentage"] for m in filtered)
-    print("Avg cloudcover:", avgcover, "Max cloud: ", maxcover)
+    cloudcover = np.array([m["cloudcoverpercentage"] for m in filtered])
+    print("Avg cloudcover:", cloudcover.mean(), "Max cloud: ", cloudcover.max())
 
     export_meta_shapes_to_shapefile(
         filtered, f"shapefiles/unique_set")
@@ -441,33 +706,33 @@ def filter_cover_set(poly):
     return filtered
 
 
-def filter_property(poly):
+def filter_property(box):
     """Test filtering entries down to smallest cover set for germany."""
     terms = {
         "platformname": "Sentinel-2",
         "producttype": "S2MSI2A",
-        "footprint": f"\"Intersects({poly})\"",
         # "cloudcoverpercentage": "0.1",
         # "snowicepercentage": "0.1",
         # "waterpercentage": "20.0",
     }
-    entries = SEARCH.search_terms(terms)
-    metas = [SEARCH.parse_entry(e) for e in entries]
-    print("All:", len(metas))
-
-    low_cloud = [m for m in metas if m["cloudcoverpercentage"] < 0.1]
-    print("Cloud:", len(low_cloud))
-    low_snow = [m for m in low_cloud if m["snowicepercentage"] < 0.1]
-    print("Snow:", len(low_snow))
-    low_water = [m for m in low_snow if m["waterpercentage"] < 20]
-    print("Water:", len(low_water))
-
-    final_2018 = [m for m in low_water if m["beginposition"].year == 2018]
+    metas = search_bound_box(terms, box)
+    frame = metas_to_frame(metas)
+    print("All:", len(frame))
+
+    low_cloud = frame["cloudcoverpercentage"] < 0.1
+    print("Cloud:", low_cloud.sum())
+    low_snow = low_cloud & (frame["snowicepercentage"] < 0.1)
+    print("Snow:", low_snow.sum())
+    low_water = low_snow & (frame["waterpercentage"] < 20)
+    print("Water:", low_water.sum())
+
+    years = pd.to_datetime(frame["beginposition"]).dt.year
+    final_2018 = frame.index[low_water & (years == 2018)]
     print("2018:", len(final_2018))
-    final_2019 = [m for m in low_water if m["beginposition"].year == 2019]
+    final_2019 = frame.index[low_water & (years == 2019)]
     print("2019:", len(final_2019))
 
-    final_both = final_2018 + final_2019
+    final_both = [metas[i] for i in final_2018] + [metas[i] for i in final_2019]
 
 
     # export_meta_shapes_to_shapefile(
@@ -478,12 +743,10 @@ def filter_property(poly):
 
 def generate_download_urls(metas, outfile="filepaths.txt"):
     uuids = [(m["uuid"], m["filename"]) for m in metas]
-    paths = []
-    all_count = len(uuids)
-    for i, (uuid, filename) in enumerate(uuids):
-        print(f"{i+1}/{all_count}", uuid)
-        path = ODATA.get_tci_image_path(uuid, filename)
-        paths.append(path)
+    print(f"Resolving {len(uuids)} TCI image paths")
+    with ThreadPoolExecutor(max_workers=ODATA_WORKERS) as executor:
+        paths = list(executor.map(
+            lambda u: ODATA.get_tci_image_path(*u), uuids))
     if outfile:
         with open(outfile, "w") as f:
             for path in paths:
@@ -491,41 +754,34 @@ def generate_download_urls(metas, outfile="filepaths.txt"):
     return paths
 
 
-def filename_to_tci_name(filename):
-    fileparts = filename.split("_")
-    tci_name = f"{fileparts[5]}_{fileparts[2]}_TCI_10m.jp2"
-    return tci_name
-
-
 def save_metadata(metas, outfile):
-    for i, meta in enumerate(metas):
-        meta["tciname"] = filename_to_tci_name(meta["filename"])
-        for k, v in meta.items():
-            if isinstance(v, datetime.datetime):
-                meta[k] = v.isoformat()
+    # Copies, since metas may be shared with the search cache
+    metas = [
+        dict(meta, tciname=filename_to_tci_name(meta["filename"]))
+        for meta in metas
+    ]
 
     if outfile:
-        with open(outfile, "w") as f:
-            json.dump(metas, f)
+        # orjson writes datetimes in ISO format
+        with open(outfile, "wb") as f:
+            f.write(orjson.dumps(metas))
 
 
 def merge_metas(meta_a, meta_b):
     """Merge two lists of meta objects on uuid"""
     metas = meta_a.copy()
-    found_uuids = [m["uuid"] for m in metas]
+    found_uuids = {m["uuid"] for m in metas}
     for meta in meta_b:
         uuid = meta["uuid"]
         if uuid not in found_uuids:
             metas.append(meta)
-            found_uuids.append(uuid)
+            found_uuids.add(uuid)
     return metas
 
 
 def main(args):
-    poly = polygon_from_bound_box(BOUNDS_GERMANY)
-
-    property_metas = filter_property(poly)
-    coverset_metas = filter_cover_set(poly)
+    property_metas = filter_property(BOUNDS_GERMANY)
+    coverset_metas = filter_cover_set(BOUNDS_GERMANY)
     metas = merge_metas(property_metas, coverset_metas)
 
     if args.urls:
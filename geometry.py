@@ -0,0 +1,22 @@
+"""
+Geometry helpers shared by the search and the tile export.
+"""
+import numpy as np
+import shapely
+
+
+def exterior_rings(geoms):
+    """Return list of exterior ring coordinates of all polygons for each of
+    the given (multi)polygons.
+
+    Coordinates of all rings are fetched in a single call and split by ring.
+    """
+    parts, geom_index = shapely.get_parts(geoms, return_index=True)
+    coords, ring_index = shapely.get_coordinates(
+        shapely.get_exterior_ring(parts), return_index=True)
+    rings = np.split(
+        coords, np.searchsorted(ring_index, np.arange(1, len(parts))))
+    geom_rings = [[] for _ in range(len(geoms))]
+    for i, ring in zip(geom_index, rings):
+        geom_rings[i].append(ring.tolist())
+    return geom_rings
@@ -3,29 +3,49 @@ Create some simple postgres queries using python.
 """
 from __future__ import annotations
 from typing import List, Tuple
+import io
 import os
-import json
+import csv
+import logging
+import tempfile
 import pathlib
-import datetime
+import itertools
+import collections
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from argparse import ArgumentParser
 
+import orjson
 import psycopg2
+import numpy as np
 import pandas as pd
 
-from rtree import index
+import shapely
 import shapefile
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.wkt import loads
+from shapely.geometry import Polygon
+
+from geometry import exterior_rings
 
 POSTGIS_HOST = os.environ["PGHOST"]
 POSTGIS_PORT = os.environ["PGPORT"]
 POSTGIS_USER = os.environ["PGUSER"]
 POSTGIS_PASSWORD = os.environ["PGPASSWORD"]
 
+LOGGER = logging.getLogger(__name__)
+
+# Number of raster tiles intersected with corine at once
+TILE_BATCH = 500
+# Number of threads writing PNG tiles in each export process
+PNG_WRITERS = 4
+
 
 class Geospatial:
     """Geospatial database inside of postgis."""
 
+    # Rows fetched per round-trip by server-side cursors and fetchmany
+    itersize = 2000
+    _cursor_ids = itertools.count()
+
     def __init__(
             self,
             host,
@@ -33,10 +53,15 @@ class Geospatial:
             user="postgres",
             password=None,
             dbname="geospatial"):
+        # Keepalives stop idle connections of export workers from being
+        # dropped during long raster transfers of other workers
         self.conn = psycopg2.connect(
-            dbname=dbname, user=user, password=password, host=host, port=port)
+            dbname=dbname, user=user, password=password, host=host, port=port,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10,
+            keepalives_count=5)
 
         self.cur = self.conn.cursor()
+        self.cur.arraysize = self.itersize
 
     def list_tables(self) -> List[str]:
         """Get a list of tables."""
@@ -47,70 +72,108 @@ class Geospatial:
         table_names = [t for t, in self.cur.fetchall()]
         return table_names
 
-    def query_iterator(self, query, columns):
-        self.cur.execute(query)
-        while True:
-            result = self.cur.fetchone()
-            if result is None:
-                break
-            yield dict(zip(columns, result))
+    def query_iterator(self, query, columns, params=None):
+        """Iterate over query results as dicts. Rows are streamed from a
+        server-side cursor in batches of itersize, instead of buffering the
+        whole result in memory."""
+        name = f"query_iterator_{next(self._cursor_ids)}"
+        with self.conn.cursor(name=name) as cur:
+            cur.itersize = self.itersize
+            cur.execute(query, params)
+            for result in cur:
+                yield dict(zip(columns, result))
+
+    def query_frame(self, query, columns, params=None) -> pd.DataFrame:
+        """Return query results as a dataframe with the given columns."""
+        frame = pd.read_sql_query(query, self.conn, params=params)
+        frame.columns = columns
+        return frame
 
     def query(self, query, columns):
+        """Return query results as dict of column lists."""
         self.cur.execute(query)
-        results = {col: [] for col in columns}
-        for result in self.cur.fetchall():
-            for i, column in enumerate(columns):
-                results[column].append(result[i])
-        return results
+        rows = self.cur.fetchall()
+        if not rows:
+            return {col: [] for col in columns}
+        return {
+            col: list(values) for col, values in zip(columns, zip(*rows))}
 
     def close(self):
         self.cur.close()
         self.conn.close()
 
     def __enter__(self):
-        print("Entering")
+        return self
 
-    def __exit__(self, *_):
-        self.conn.commit()
+    def __exit__(self, exc_type, *_):
+        """Commit changes, unless the block raised, and close the
+        connection."""
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
 
 
-def get_raster_tables(gs: Geospatial, metadata: str) -> pd.DataFrame:
+def get_raster_tables(
+        gs: Geospatial,
+        metadata: str,
+        max_cloudcover: float = 1.0,
+        max_snowcover: float = 1.0,
+        max_waterpercentage: float = 80.0) -> pd.DataFrame:
     """Get a list of raster tables with associated metadata in json from
     previous opensearch query. Return a pandas dataframe with metadata in
-    columns."""
-    result = gs.query(
-        """SELECT r_table_name, ST_AsText(ST_Transform(extent, 4326))
-        FROM raster_columns""",
-        ("r_table_name", "bound")
-    )
+    columns.
 
-    with open(metadata) as mfile:
-        metas = json.load(mfile)
-
-    tci_meta = {}
-    for meta in metas:
-        tci_name = meta["tciname"].rstrip(".jp2").lower()
-        tci_meta[tci_name] = meta
-
-    result["date"] = []
-    result["cloudcover"] = []
-    result["snowcover"] = []
-    result["waterpercentage"] = []
-    result["footprint"] = []
-    for name in result["r_table_name"]:
-        datestr = name.split("_")[1]
-        date = datetime.datetime.strptime(datestr, "%Y%m%dt%H%M%S")
-        result["date"].append(date)
-        meta = tci_meta[name]
-        result["cloudcover"].append(meta["cloudcoverpercentage"])
-        result["snowcover"].append(meta["snowicepercentage"])
-        result["waterpercentage"].append(meta["waterpercentage"])
-        result["footprint"].append(meta["footprint"])
-    return pd.DataFrame.from_dict(result)
+    Only tables within the given cloud, snow and water limits are returned.
+    The metadata is copied into a temporary table, so that the limits are
+    applied by PostGIS in the same query. Only the SRID is read from
+    raster_columns, so that tile queries can transform the footprint once.
+    """
+    with open(metadata, "rb") as mfile:
+        metas = orjson.loads(mfile.read())
+
+    # Table names are the lowercase TCI image names without .jp2 suffix
+    tci_meta = {m["tciname"][:-len(".jp2")].lower(): m for m in metas}
+
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    for tci_name, meta in tci_meta.items():
+        writer.writerow((
+            tci_name,
+            meta["cloudcoverpercentage"],
+            meta["snowicepercentage"],
+            meta["waterpercentage"],
+            meta["footprint"],
+        ))
+    rows.seek(0)
+    # Dropped again with the end of the transaction
+    gs.cur.execute(
+        """CREATE TEMPORARY TABLE tci_meta (
+            tci_name text, cloudcover double precision,
+            snowcover double precision, waterpercentage double precision,
+            footprint text) ON COMMIT DROP""")
+    gs.cur.copy_expert("COPY tci_meta FROM STDIN WITH (FORMAT csv)", rows)
+
+    result = gs.query_frame(
+        """SELECT r.r_table_name, r.srid,
+            m.cloudcover, m.snowcover, m.waterpercentage, m.footprint
+        FROM raster_columns AS r
+        JOIN tci_meta AS m ON m.tci_name = r.r_table_name
+        WHERE m.cloudcover <= %s AND m.snowcover <= %s
+            AND m.waterpercentage <= %s""",
+        ("r_table_name", "srid", "cloudcover", "snowcover", "waterpercentage",
+         "footprint"),
+        params=(max_cloudcover, max_snowcover, max_waterpercentage),
+    )
+    gs.conn.commit()
+    result["date"] = pd.to_datetime(
+        result["r_table_name"].str.split("_").str[1], format="%Y%m%dt%H%M%S")
+    return result
 
 
 class Corine:
-    """Manage intersections against the Corine dataset using rtree.
+    """Manage intersections against the Corine dataset using a STRtree.
     """
     def __init__(
             self,
@@ -118,173 +181,315 @@ class Corine:
             index_name: str = "corine",
             force_reload: bool = False,
             dbname: str = "corinagermanydata"):
-        self._dbname = dbname
-        # Load previous rtree index or generate new
-        if not pathlib.Path(f"{index_name}.idx").exists() or force_reload:
-            self._idx = index.Index(index_name)
-            self._load_corine(gs, index_name)
-        else:
-            with open(f"{index_name}.json", "r") as handle:
-                self._corine = json.load(handle)
-            self._corine["shapes"] = [
-                loads(p) for p in self._corine["polygon"]]
-            self._idx = index.Index(index_name)
-
-    def _load_corine(self, gs: Geospatial, index_name):
-        """Query corine information from PostGIS server."""
-        self._corine = gs.query(
-            f"""SELECT id, code_18, ST_AsText(ST_Transform(geom, 4326))
-            FROM {self._dbname}""", ("id", "code_18", "polygon"))
-        with open(f"{index_name}.json", "w") as handle:
-            json.dump(self._corine, handle)
-        self._corine["shapes"] = []
-
-        for i, corine_id in enumerate(self._corine["id"]):
-            poly = loads(self._corine["polygon"][i])
-            self._idx.insert(i, poly.bounds)
-            self._corine["shapes"].append(poly)
+        # Load previously queried corine data or query it from PostGIS
+        cache_path = self.prepare_cache(gs, index_name, force_reload, dbname)
+        corine = pd.read_parquet(str(cache_path), memory_map=True)
+        self._ids = corine["id"].to_numpy()
+        self._codes = corine["code_18"].to_numpy()
+        self._shapes = shapely.from_wkb(corine["wkb"].to_numpy())
+        self._tree = shapely.STRtree(self._shapes)
+
+    @classmethod
+    def prepare_cache(
+            cls,
+            gs: Geospatial = None,
+            index_name: str = "corine",
+            force_reload: bool = False,
+            dbname: str = "corinagermanydata") -> pathlib.Path:
+        """Query corine data from PostGIS into the local cache, unless it has
+        been cached before. Return path of the cache file.
+        """
+        cache_path = pathlib.Path(f"{index_name}.parquet")
+        if not cache_path.exists() or force_reload:
+            corine = cls._load_corine(gs, dbname)
+            corine.to_parquet(str(cache_path), index=False)
+        return cache_path
+
+    @staticmethod
+    def _load_corine(gs: Geospatial, dbname: str) -> pd.DataFrame:
+        """Query corine information from PostGIS server. Polygons are
+        returned as WKB, which is stored and parsed far quicker than WKT.
+
+        Rows are copied as CSV into a temporary file and parsed by pandas,
+        instead of building Python row tuples for the whole table.
+        """
+        with tempfile.TemporaryFile("w+") as rows:
+            gs.cur.copy_expert(
+                f"""COPY (
+                    SELECT id, code_18,
+                        encode(ST_AsBinary(ST_Transform(geom, 4326)), 'hex')
+                    FROM {dbname}
+                ) TO STDOUT WITH (FORMAT csv)""", rows)
+            rows.seek(0)
+            corine = pd.read_csv(
+                rows, names=["id", "code_18", "wkb"], dtype={"code_18": str})
+        corine["wkb"] = corine["wkb"].map(bytes.fromhex)
+        return corine
 
     def close(self):
-        self._idx.close()
+        self._tree = None
 
     def intersect(self, shape: Polygon) -> List[Tuple[str, str, float]]:
         """Intersect the given shape against the corine dataset and return
         list of labels and their area ratios.
         """
-        intersections = []
-        shape_area = shape.area
-        # GENERAL INTERSECTION WITH BOUNDS
-        for is_id in self._idx.intersection(shape.bounds):
-            corine_shape = self._corine["shapes"][is_id]
-            is_area = shape.intersection(corine_shape).area
-            if is_area > 0:
-                ratio = is_area / shape_area
-                intersections.append(
-                    (
-                        self._corine["id"][is_id],
-                        self._corine["code_18"][is_id],
-                        ratio
-                    )
-                )
+        return self.intersect_many([shape])[0]
+
+    def intersect_many(self, shapes) -> List[List[Tuple[str, str, float]]]:
+        """Intersect all given shapes against the corine dataset in a single
+        bulk tree query. Return list of labels and area ratios for each
+        shape."""
+        shapes = np.asarray(shapes, dtype=object)
+        shape_ids, is_ids = self._tree.query(shapes, predicate="intersects")
+        order = np.lexsort((is_ids, shape_ids))
+        shape_ids, is_ids = shape_ids[order], is_ids[order]
+        ratios = shapely.area(
+            shapely.intersection(shapes[shape_ids], self._shapes[is_ids])
+        ) / shapely.area(shapes)[shape_ids]
+        found = ratios > 0
+        is_ids = is_ids[found]
+
+        intersections = [[] for _ in range(len(shapes))]
+        for shape_id, *intersection in zip(
+                shape_ids[found].tolist(),
+                self._ids[is_ids].tolist(),
+                self._codes[is_ids].tolist(),
+                ratios[found].tolist()):
+            intersections[shape_id].append(tuple(intersection))
+        return intersections
+
+
+class PostgisCorine:
+    """Manage intersections against the Corine dataset inside of PostGIS.
 
+    Tiles are intersected server-side using the spatial index of the Corine
+    table, instead of loading all polygons locally. The Corine geometries are
+    expected in EPSG:4326 with a GIST index on geom, as created by
+    shp2pgsql -I above.
+    """
+    def __init__(self, gs: Geospatial, dbname: str = "corinagermanydata"):
+        # Separate cursor, since tiles are intersected while iterating over
+        # results of the main cursor
+        self._cur = gs.conn.cursor()
+        self._query = f"""WITH tile AS (
+                SELECT t.n, ST_GeomFromWKB(t.wkb, 4326) AS geom
+                FROM unnest(%s::bytea[]) WITH ORDINALITY AS t(wkb, n))
+            SELECT tile.n, c.id, c.code_18,
+                ST_Area(ST_Intersection(c.geom, tile.geom)) / ST_Area(tile.geom)
+            FROM {dbname} AS c JOIN tile ON ST_Intersects(c.geom, tile.geom)
+            ORDER BY tile.n, c.id"""
+
+    def close(self):
+        self._cur.close()
+
+    def intersect(self, shape: Polygon) -> List[Tuple[str, str, float]]:
+        """Intersect the given shape against the corine dataset and return
+        list of labels and their area ratios.
+        """
+        return self.intersect_many([shape])[0]
+
+    def intersect_many(self, shapes) -> List[List[Tuple[str, str, float]]]:
+        """Intersect all given shapes against the corine dataset in a single
+        query. Return list of labels and area ratios for each shape."""
+        self._cur.execute(
+            self._query, ([psycopg2.Binary(s.wkb) for s in shapes],))
+        intersections = [[] for _ in range(len(shapes))]
+        for n, corine_id, code, ratio in self._cur.fetchall():
+            if ratio > 0:
+                intersections[n - 1].append((corine_id, code, ratio))
         return intersections
 
 
-def export_images_dataset(outdir, corinedb, metafile):
-    outdir = pathlib.Path(outdir)
-    outdir.mkdir(parents=True, exist_ok=True)
-    name = str(outdir.name)
+def intersect_tiles(rasts, cori, batch_size=TILE_BATCH):
+    """Yield raster tile rows together with their envelope shape and corine
+    intersections. Tiles are intersected with corine in batches."""
+    while True:
+        batch = list(itertools.islice(rasts, batch_size))
+        if not batch:
+            break
+        shapes = shapely.from_wkb([bytes(rast["geom"]) for rast in batch])
+        yield from zip(batch, shapes, cori.intersect_many(shapes))
+
 
+# Database connection and corine dataset of an export worker process
+_WORKER = {}
+
+
+def _init_export_worker(corinedb: str, server_corine: bool):
+    """Open the database connection and corine dataset of a worker."""
     gs = Geospatial(
         POSTGIS_HOST, port=POSTGIS_PORT,
         password=POSTGIS_PASSWORD, user=POSTGIS_USER)
+    _WORKER["gs"] = gs
+    if server_corine:
+        _WORKER["corine"] = PostgisCorine(gs, dbname=corinedb)
+    else:
+        _WORKER["corine"] = Corine(gs, dbname=corinedb)
+    # Worker processes do not run atexit handlers, but multiprocessing
+    # finalizers with an exit priority
+    multiprocessing.util.Finalize(None, _close_export_worker, exitpriority=10)
+
+
+def _close_export_worker():
+    """Close the corine dataset and database connection of a worker."""
+    _WORKER.pop("corine").close()
+    _WORKER.pop("gs").close()
+
+
+def export_table(row: dict, outdir: pathlib.Path) -> list:
+    """Export all tiles of a single raster table into outdir. Tiles are
+    stored as PNG in directories by year and major corine class.
 
-    cori = Corine(gs, dbname=corinedb)
-    dataset = get_raster_tables(gs, metafile)
+    Return list of shapefile polygon coordinates and records of all tiles.
+    """
+    gs = _WORKER["gs"]
+    cori = _WORKER["corine"]
+    name = row["r_table_name"]
+    # Get all tiles with 120x120 width and intersected on satellite image
+    # footprint to avoid black tiles, since images are always rectangular.
+    # The footprint is transformed once into the raster SRID, so that only
+    # returned tiles have to be transformed.
+    query = gs.query_iterator(
+        f"""SELECT rid, ST_AsPNG(rast), ST_AsBinary(ST_Transform(ST_Envelope(rast), 4326))
+        FROM {name} WHERE
+        ST_Intersects(ST_Envelope(rast), ST_Transform(ST_GeomFromText(%s, 4326), %s))
+        AND
+        ST_Width(rast) = 120 AND ST_Height(rast) = 120
+        """,
+        ("rid", "png", "geom"),
+        (row["footprint"], int(row["srid"])),
+    )
+    tile_metadata = []
     failed = []
-    filtered_out = 0
+    tile_shapes = []
+    records = []
+    writes = []
+    # Write PNG files in background threads, while the next tiles are
+    # fetched and intersected
+    try:
+        with ThreadPoolExecutor(max_workers=PNG_WRITERS) as writers:
+            # intersect tiles against corine and add to dataset if any
+            # intersections
+            for rast, shape, corine_classes in intersect_tiles(query, cori):
+                tile_name = f"{name}_T{rast['rid']}"
+                LOGGER.debug("Tile %s: %s", rast["rid"], shape)
+                if corine_classes:
+                    # merge corine intersections with same label
+                    summed_ratios = collections.defaultdict(int)
+                    for _, corine_class, ratio in corine_classes:
+                        summed_ratios[corine_class] += ratio
+                    highest_key = max(
+                        summed_ratios, key=lambda c: summed_ratios[c])
+                    highest_class = (
+                        "", highest_key, summed_ratios[highest_key])
+                    LOGGER.debug("%s %s", highest_class, corine_classes)
+                    filedir = (
+                        outdir / str(row["date"].year) / highest_class[1])
+                    filedir.mkdir(parents=True, exist_ok=True)
+                    filepath = (
+                        filedir / f"{tile_name}_p{highest_class[2]:.2f}.png")
+                    writes.append(
+                        writers.submit(filepath.write_bytes, rast["png"]))
+                    tile_metadata.append(
+                        {
+                            "name": tile_name,
+                            "geom": shape.wkt,
+                            "date": row["date"].isoformat(),
+                            "snowcover": row["snowcover"],
+                            "cloudcover": row["cloudcover"],
+                            "corine_classes": corine_classes,
+                            "max_class": highest_class,
+                        }
+                    )
+                else:
+                    highest_class = ("", "", 1.0)
+                    failed.append({"name": tile_name, "geom": shape.wkt})
+
+                tile_shapes.append(shape)
+                records.append((
+                    tile_name, row["date"].year,
+                    highest_class[1], highest_class[2]))
+    finally:
+        query.close()
+        # End the transaction, also after errors, so that the connection is
+        # neither aborted nor idle in transaction for the next table
+        gs.conn.rollback()
+    for write in writes:
+        write.result()
+
+    # pandas may hand out numpy scalars for the metadata columns
+    with open(str(outdir / f"{name}.json"), "wb") as handle:
+        handle.write(orjson.dumps(
+            tile_metadata, option=orjson.OPT_SERIALIZE_NUMPY))
+
+    with open(str(outdir / f"{name}_failed.json"), "wb") as handle:
+        handle.write(orjson.dumps(failed))
+
+    # exterior rings of all tile (multi)polygons
+    return list(zip(exterior_rings(tile_shapes), records))
+
+
+def export_images_dataset(
+        outdir, corinedb, metafile, server_corine=False, jobs=None):
+    """Export tiles of all raster tables fulfilling the dataset criteria.
+    Tables are exported in parallel by jobs processes, each with its own
+    database connection."""
+    outdir = pathlib.Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    name = str(outdir.name)
+
+    with Geospatial(
+            POSTGIS_HOST, port=POSTGIS_PORT,
+            password=POSTGIS_PASSWORD, user=POSTGIS_USER) as gs:
+        # Prepare corine cache once, before workers start using it
+        if not server_corine:
+            Corine.prepare_cache(gs, dbname=corinedb)
+        dataset = get_raster_tables(gs, metafile)
 
+    LOGGER.info("Exporting %d raster tables", len(dataset))
     # Add information on patches into shp file usable for visualization
-    shp = shapefile.Writer(f"{name}.shp")
-    shp.field("name", "C")
-    shp.field("year", "N")
-    shp.field("type", "C")
-    shp.field("ratio", "N", decimal=2)
-
-    for _, row in dataset.iterrows():
-        name = row["r_table_name"]
-        # Skip datasets not fulfilling criteria
-        if row["cloudcover"] > 1.0:
-            filtered_out += 1
-            continue
-        if row["snowcover"] > 1.0:
-            filtered_out += 1
-            continue
-        if row["waterpercentage"] > 80.0:
-            filtered_out += 1
-            continue
-        # Get all tiles with 120x120 width and intersected on satellite image
-        # footprint to avoid black tiles, since images are always rectangular.
-        query = gs.query_iterator(
-            f"""SELECT rid, ST_AsPNG(rast), ST_AsText(ST_Transform(ST_Envelope(rast), 4326))
-            FROM {name} WHERE
-            ST_Intersects(ST_Transform(ST_Envelope(rast), 4326), ST_GeometryFromText('SRID=4326;{row['footprint']}'))
-            AND
-            ST_Width(rast) = 120 AND ST_Height(rast) = 120
-            """,
-            ("rid", "png", "geom")
-        )
-        tile_metadata = []
-        for rast in query:
-            print(rast)
-            tile_name = f"{name}_T{rast['rid']}"
-            shape = loads(rast["geom"])
-            # intersect tile against corine and add to dataset if any
-            # intersections
-            corine_classes = cori.intersect(shape)
-            if corine_classes:
-                # merge corine intersections with same label
-                summed_ratios = collections.defaultdict(int)
-                for _, corine_class, ratio in corine_classes:
-                    summed_ratios[corine_class] += ratio
-                highest_key = max(summed_ratios, key=lambda c: summed_ratios[c])
-                highest_class = ("", highest_key, summed_ratios[highest_key])
-                print(highest_class, corine_classes)
-                filedir = outdir / str(row["date"].year) / highest_class[1]
-                filedir.mkdir(parents=True, exist_ok=True)
-                filepath = filedir / f"{tile_name}_p{highest_class[2]:.2f}.png"
-                with open(str(filepath), "wb") as handle:
-                    handle.write(rast["png"])
-                tile_metadata.append(
-                    {
-                        "name": tile_name,
-                        "geom": rast["geom"],
-                        "date": row["date"].isoformat(),
-                        "snowcover": row["snowcover"],
-                        "cloudcover": row["cloudcover"],
-                        "corine_classes": corine_classes,
-                        "max_class": highest_class,
-                    }
-                )
-            else:
-                highest_class = ("", "", 1.0)
-                failed.append({"name": tile_name, "geom": rast["geom"]})
-
-            if isinstance(shape, MultiPolygon):
-                coords = [list(poly.exterior.coords) for poly in shape.geoms]
-            else:
-                coords = [list(shape.exterior.coords)]
-            shp.poly(coords)
-            shp.record(
-                tile_name,
-                row["date"].year,
-                highest_class[1],
-                highest_class[2],
-            )
-            print("--------")
-
-        with open(str(outdir / f"{name}.json"), "w") as handle:
-            json.dump(tile_metadata, handle)
-
-        with open(str(outdir / f"{name}_failed.json"), "w") as handle:
-            json.dump(failed, handle)
-
-    shp.close()
-
-    print(filtered_out)
-    cori.close()
-    gs.close()
+    with shapefile.Writer(f"{name}.shp") as shp, ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_export_worker,
+            initargs=(corinedb, server_corine)) as executor:
+        shp.field("name", "C")
+        shp.field("year", "N")
+        shp.field("type", "C")
+        shp.field("ratio", "N", decimal=2)
+
+        tables = [
+            executor.submit(export_table, row, outdir)
+            for row in dataset.to_dict("records")
+        ]
+        try:
+            for table in tables:
+                for coords, record in table.result():
+                    shp.poly(coords)
+                    shp.record(*record)
+        except BaseException:
+            # Do not start remaining tables once one has failed
+            for table in tables:
+                table.cancel()
+            raise
 
 
 def main(args):
-    export_images_dataset(args.output, args.corine, args.metadata)
+    export_images_dataset(
+        args.output, args.corine, args.metadata, args.server_corine,
+        args.jobs)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     PARSER = ArgumentParser()
     PARSER.add_argument("output", help="Output dataset directory")
     PARSER.add_argument(
         "--metadata", default="metadata.json", help="Tile metadata json")
     PARSER.add_argument(
         "--corine", default="corinagermanydata", help="Corine data table")
+    PARSER.add_argument(
+        "--server-corine", action="store_true",
+        help="Intersect tiles with corine inside of PostGIS")
+    PARSER.add_argument(
+        "--jobs", type=int, default=None,
+        help="Number of tables exported in parallel, defaults to CPU count")
     main(PARSER.parse_args())
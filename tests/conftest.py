@@ -0,0 +1,12 @@
+"""
+Make the scripts importable without database or Copernicus access.
+"""
+import os
+import sys
+import pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+for _name in ("PGHOST", "PGPORT", "PGUSER", "PGPASSWORD",
+              "COPERNICUS_USER", "COPERNICUS_PASS"):
+    os.environ.setdefault(_name, "test")
@@ -0,0 +1,30 @@
+from copernicus_links import tile_bounds, z_order
+
+
+def test_z_order():
+    assert [z_order(x, y) for y in range(2) for x in range(2)] == [
+        0, 1, 2, 3]
+
+
+def test_tile_bounds_single():
+    assert tile_bounds(("0", "0", "2", "1"), 1, 1) == (
+        ("0.00000", "0.00000", "2.00000", "1.00000"),)
+
+
+def test_tile_bounds_grid():
+    cells = tile_bounds(("0", "0", "2", "2"), 2, 2)
+    assert cells == (
+        ("0.00000", "0.00000", "1.00000", "1.00000"),
+        ("1.00000", "0.00000", "2.00000", "1.00000"),
+        ("0.00000", "1.00000", "1.00000", "2.00000"),
+        ("1.00000", "1.00000", "2.00000", "2.00000"),
+    )
+
+
+def test_tile_bounds_cover_box():
+    cells = tile_bounds(("5.86442", "47.26543", "15.05078", "55.14777"))
+    area = sum(
+        (float(x2) - float(x1)) * (float(y2) - float(y1))
+        for x1, y1, x2, y2 in cells)
+    assert len(set(cells)) == len(cells)
+    assert abs(area - (15.05078 - 5.86442) * (55.14777 - 47.26543)) < 1e-3
@@ -0,0 +1,31 @@
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from geometry import exterior_rings
+
+
+def test_exterior_rings_empty():
+    assert exterior_rings([]) == []
+
+
+def test_exterior_rings_polygon():
+    assert exterior_rings([box(0, 0, 1, 1)]) == [
+        [[[1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.0, 0.0], [1.0, 0.0]]]]
+
+
+def test_exterior_rings_multipolygon_keeps_order():
+    geoms = [
+        MultiPolygon([box(0, 0, 1, 1), box(2, 2, 3, 3)]),
+        box(5, 5, 6, 6),
+    ]
+    rings = exterior_rings(geoms)
+    assert [len(r) for r in rings] == [2, 1]
+    assert rings[0][0][0] == [1.0, 0.0]
+    assert rings[0][1][0] == [3.0, 2.0]
+    assert rings[1][0][0] == [6.0, 5.0]
+
+
+def test_exterior_rings_skip_holes():
+    shell = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]
+    hole = [(1, 1), (2, 1), (2, 2), (1, 2), (1, 1)]
+    assert exterior_rings([Polygon(shell, [hole])]) == [
+        [[list(map(float, p)) for p in shell]]]
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+from shapely.geometry import MultiPolygon, box
+
+from query_postgis import Corine, intersect_tiles
+
+
+@pytest.fixture
+def corine(tmp_path):
+    """Corine dataset of two classes side by side, loaded from a local
+    cache file instead of PostGIS."""
+    shapes = [box(0, 0, 1, 1), box(1, 0, 2, 1)]
+    pd.DataFrame({
+        "id": [1, 2],
+        "code_18": ["111", "211"],
+        "wkb": [s.wkb for s in shapes],
+    }).to_parquet(str(tmp_path / "corine.parquet"), index=False)
+    return Corine(index_name=str(tmp_path / "corine"))
+
+
+def test_intersect_many_empty(corine):
+    assert corine.intersect_many([]) == []
+
+
+def test_intersect_many_no_hits(corine):
+    assert corine.intersect_many([box(5, 5, 6, 6)]) == [[]]
+
+
+def test_intersect_many_keeps_order_per_tile(corine):
+    tiles = [box(1.5, 0, 2, 1), box(5, 5, 6, 6), box(0.5, 0, 1.5, 1)]
+    assert corine.intersect_many(tiles) == [
+        [(2, "211", 1.0)],
+        [],
+        [(1, "111", 0.5), (2, "211", 0.5)],
+    ]
+
+
+def test_intersect_many_multipolygon(corine):
+    tile = MultiPolygon([box(0, 0, 0.5, 1), box(1.5, 0, 2, 1)])
+    assert corine.intersect_many([tile]) == [
+        [(1, "111", 0.5), (2, "211", 0.5)]]
+
+
+def test_intersect_matches_intersect_many(corine):
+    tile = box(0.75, 0, 1.25, 1)
+    assert corine.intersect(tile) == corine.intersect_many([tile])[0]
+
+
+def test_intersect_tiles_batches(corine):
+    tiles = [box(0, 0, 1, 1), box(5, 5, 6, 6), box(1, 0, 2, 1)]
+    rasts = iter([{"rid": i, "geom": t.wkb} for i, t in enumerate(tiles)])
+    result = list(intersect_tiles(rasts, corine, batch_size=2))
+    assert [rast["rid"] for rast, _, _ in result] == [0, 1, 2]
+    assert [shape.equals(t) for (_, shape, _), t in zip(result, tiles)] == [
+        True, True, True]
+    assert [classes for _, _, classes in result] == [
+        [(1, "111", 1.0)], [], [(2, "211", 1.0)]]
+
+
+def test_intersect_tiles_empty(corine):
+    assert list(intersect_tiles(iter([]), corine)) == []